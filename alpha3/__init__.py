@@ -1,2 +1,2 @@
-from alpha3.connectk import ConnectK
+from alpha3.a3mcts import ConnectK
 from alpha3.train import train, Config
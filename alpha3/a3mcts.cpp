@@ -1,7 +1,15 @@
 #include <Python.h>
 #include <stddef.h>
 
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
+
+#include <bitset>
+#include <string>
+
+#include "connectk.h"
 #include "mcts.h"
+#include "mctspool.h"
 
 struct PythonHandle {
   PyObject *object;
@@ -45,10 +53,12 @@ struct PythonHandle {
 
 struct TypeSpec {
   const char *name;
+  const char *qualified_name;
   size_t size;
   newfunc create;
   destructor destroy;
   PyMethodDef *methods;
+  reprfunc str;
 };
 
 static PythonHandle create_type(const TypeSpec *spec);
@@ -96,8 +106,77 @@ static PyMethodDef mcts_methods[] = {
     {"reset", (PyCFunction)mcts_reset, METH_VARARGS | METH_KEYWORDS, NULL},
     {NULL, NULL, -1, NULL}};
 
-const static TypeSpec mcts_typespec = {"MCTS", sizeof(PyMCTS), mcts_create,
-                                       mcts_destroy, mcts_methods};
+const static TypeSpec mcts_typespec = {
+    "MCTS",       "alpha3.a3mcts.MCTS", sizeof(PyMCTS), mcts_create,
+    mcts_destroy, mcts_methods,         NULL};
+
+struct PyConnectK {
+  PyObject_HEAD ConnectK state;
+};
+
+static PyObject *connectk_create(PyTypeObject *type, PyObject *args,
+                                 PyObject *kwargs);
+
+static void connectk_destroy(PyObject *self);
+
+static PyObject *connectk_wrap(PyTypeObject *type, const ConnectK &state);
+
+static PyObject *connectk_moves(PyObject *self, PyObject *args);
+static PyObject *connectk_play(PyObject *self, PyObject *column);
+static PyObject *connectk_position(PyObject *self, PyObject *args,
+                                   PyObject *kwargs);
+static PyObject *connectk_outcome(PyObject *self, PyObject *args);
+static PyObject *connectk_reduce(PyObject *self, PyObject *args);
+static PyObject *connectk_from_state(PyObject *type, PyObject *args);
+static PyObject *connectk_str(PyObject *self);
+
+static PyMethodDef connectk_methods[] = {
+    {"moves", connectk_moves, METH_NOARGS, NULL},
+    {"play", connectk_play, METH_O, NULL},
+    {"position", (PyCFunction)connectk_position, METH_VARARGS | METH_KEYWORDS,
+     NULL},
+    {"outcome", connectk_outcome, METH_NOARGS, NULL},
+    {"__reduce__", connectk_reduce, METH_NOARGS, NULL},
+    {"_from_state", connectk_from_state, METH_VARARGS | METH_CLASS, NULL},
+    {NULL, NULL, -1, NULL}};
+
+// ConnectK states are pickled when they're sent between processes, which requires
+// the type to be importable by its qualified name
+const static TypeSpec connectk_typespec = {
+    "ConnectK",       "alpha3.a3mcts.ConnectK", sizeof(PyConnectK),
+    connectk_create,  connectk_destroy,         connectk_methods,
+    connectk_str};
+
+struct PyMCTSPool {
+  PyObject_HEAD MCTSPool pool;
+};
+
+static PyObject *mctspool_create(PyTypeObject *type, PyObject *args,
+                                 PyObject *kwargs);
+
+static void mctspool_destroy(PyObject *self);
+
+static PyObject *mctspool_collect_batch(PyObject *self, PyObject *args,
+                                        PyObject *kwargs);
+static PyObject *mctspool_deliver_batch(PyObject *self, PyObject *args,
+                                        PyObject *kwargs);
+static PyObject *mctspool_collect_results(PyObject *self, PyObject *args);
+
+static PyMethodDef mctspool_methods[] = {
+    {"collect_batch", (PyCFunction)mctspool_collect_batch,
+     METH_VARARGS | METH_KEYWORDS, NULL},
+    {"deliver_batch", (PyCFunction)mctspool_deliver_batch,
+     METH_VARARGS | METH_KEYWORDS, NULL},
+    {"collect_results", mctspool_collect_results, METH_NOARGS, NULL},
+    {NULL, NULL, -1, NULL}};
+
+const static TypeSpec mctspool_typespec = {
+    "MCTSPool",       "alpha3.a3mcts.MCTSPool", sizeof(PyMCTSPool),
+    mctspool_create,  mctspool_destroy,         mctspool_methods,
+    NULL};
+
+// Set when the module is initialized, so that MCTSPool can check its initial state's type
+static PyTypeObject *connectk_type = NULL;
 
 static PyModuleDef module_defn = {
     PyModuleDef_HEAD_INIT, "a3mcts", NULL, 0, NULL, NULL, NULL, NULL, NULL};
@@ -124,24 +203,32 @@ static PythonHandle iterator_to_list(Iterator begin, Iterator end, Fn fn) {
 }
 
 extern "C" PyObject *PyInit_a3mcts(void) {
+  import_array();
+
   PythonHandle module(PyModule_Create(&module_defn));
 
   if (module.null()) {
     return NULL;
   }
 
-  PythonHandle mcts_type(create_type(&mcts_typespec));
+  for (const TypeSpec *spec :
+       {&mcts_typespec, &connectk_typespec, &mctspool_typespec}) {
+    PythonHandle type(create_type(spec));
 
-  if (mcts_type.null()) {
-    return NULL;
-  }
+    if (type.null()) {
+      return NULL;
+    }
 
-  if (PyModule_AddObject(module.object, mcts_typespec.name, mcts_type.object) <
-      0) {
-    return NULL;
-  }
+    if (spec == &connectk_typespec) {
+      connectk_type = (PyTypeObject *)type.object;
+    }
 
-  mcts_type.steal();
+    if (PyModule_AddObject(module.object, spec->name, type.object) < 0) {
+      return NULL;
+    }
+
+    type.steal();
+  }
 
   return module.steal();
 }
@@ -159,11 +246,12 @@ static PythonHandle create_type(const TypeSpec *spec) {
   PythonHandle type((PyObject *)buffer);
 
   auto tp = (PyTypeObject *)type.object;
-  tp->tp_name = spec->name;
+  tp->tp_name = spec->qualified_name;
   tp->tp_basicsize = spec->size;
   tp->tp_new = spec->create;
   tp->tp_dealloc = spec->destroy;
   tp->tp_methods = spec->methods;
+  tp->tp_str = spec->str;
   tp->tp_flags = Py_TPFLAGS_DEFAULT;
 
   if (PyType_Ready(tp) < 0) {
@@ -566,3 +654,507 @@ static bool assert_tuple_length(PyObject *tuple, size_t length) {
                (unsigned int)length);
   return false;
 }
+
+static PyObject *mctspool_create(PyTypeObject *type, PyObject *args,
+                                 PyObject *kwargs) {
+  PyObject *initial_state;
+  MCTSPool::Config config;
+
+  static char initial_state_str[] = "initial_state";
+  static char trees_str[] = "trees";
+  static char leaves_per_tree_str[] = "leaves_per_tree";
+  static char evaluations_str[] = "evaluations";
+  static char max_turns_str[] = "max_turns";
+  static char c_init_str[] = "c_init";
+  static char c_base_str[] = "c_base";
+  static char noise_alpha_str[] = "noise_alpha";
+  static char noise_fraction_str[] = "noise_fraction";
+
+  static char *keyword_names[] = {
+      initial_state_str, trees_str,          leaves_per_tree_str,
+      evaluations_str,   max_turns_str,      c_init_str,
+      c_base_str,        noise_alpha_str,    noise_fraction_str,
+      NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(
+          args, kwargs, "O!nnnndddd", keyword_names, connectk_type,
+          &initial_state, &config.trees, &config.leaves_per_tree,
+          &config.evaluations, &config.max_turns, &config.c_init,
+          &config.c_base, &config.noise_alpha, &config.noise_fraction)) {
+    return NULL;
+  }
+
+  if ((Py_ssize_t)config.trees <= 0 || (Py_ssize_t)config.leaves_per_tree <= 0 ||
+      (Py_ssize_t)config.evaluations <= 0 || (Py_ssize_t)config.max_turns <= 0) {
+    PyErr_SetString(PyExc_ValueError,
+                    "trees, leaves_per_tree, evaluations and max_turns must be "
+                    "positive");
+    return NULL;
+  }
+
+  if (((PyConnectK *)initial_state)->state.over()) {
+    PyErr_SetString(PyExc_ValueError, "initial_state must be ongoing");
+    return NULL;
+  }
+
+  PythonHandle self(PyObject_New(PyObject, type));
+
+  if (self.null()) {
+    return NULL;
+  }
+
+  void *location = &((PyMCTSPool *)self.object)->pool;
+
+  try {
+    new (location) MCTSPool(config, ((PyConnectK *)initial_state)->state);
+  } catch (std::bad_alloc &) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+
+  return self.steal();
+}
+
+static void mctspool_destroy(PyObject *self) {
+  auto &pool = ((PyMCTSPool *)self)->pool;
+  pool.~MCTSPool();
+  Py_TYPE(self)->tp_free(self);
+}
+
+static PyObject *mctspool_collect_batch(PyObject *self, PyObject *args,
+                                        PyObject *kwargs) {
+  static char out_str[] = "out";
+  static char *keyword_names[] = {out_str, NULL};
+
+  PyObject *out_object = Py_None;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", keyword_names,
+                                   &out_object)) {
+    return NULL;
+  }
+
+  auto &pool = ((PyMCTSPool *)self)->pool;
+
+  const npy_intp rows = (npy_intp)pool.game().rows();
+  const npy_intp columns = (npy_intp)pool.game().columns();
+
+  // If given, out must be able to hold the largest possible batch; the positions are
+  // written to its leading rows, and a view of those rows is returned
+  if (out_object != Py_None) {
+    PyArrayObject *out = (PyArrayObject *)out_object;
+
+    if (!PyArray_Check(out_object) || PyArray_TYPE(out) != NPY_FLOAT32 ||
+        !PyArray_ISCARRAY(out) || PyArray_NDIM(out) != 4 ||
+        PyArray_DIM(out, 0) < (npy_intp)pool.max_batch() ||
+        PyArray_DIM(out, 1) != 2 || PyArray_DIM(out, 2) != rows ||
+        PyArray_DIM(out, 3) != columns) {
+      PyErr_Format(PyExc_ValueError,
+                   "expected a writable, C-contiguous float32 array of "
+                   "shape (%zu or more, 2, %u, %u)",
+                   pool.max_batch(), (unsigned)rows, (unsigned)columns);
+      return NULL;
+    }
+  }
+
+  if (pool.pending() != 0) {
+    PyErr_SetString(PyExc_RuntimeError,
+                    "the previous batch hasn't been delivered");
+    return NULL;
+  }
+
+  size_t size;
+
+  try {
+    size = pool.collect_batch();
+  } catch (std::bad_alloc &) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+
+  PythonHandle positions;
+
+  if (out_object == Py_None) {
+    npy_intp dims[] = {(npy_intp)size, 2, rows, columns};
+    positions = PythonHandle(PyArray_SimpleNew(4, dims, NPY_FLOAT32));
+  } else {
+    positions = PythonHandle(PySequence_GetSlice(out_object, 0, (Py_ssize_t)size));
+  }
+
+  if (positions.null()) {
+    return NULL;
+  }
+
+  pool.positions((float *)PyArray_DATA((PyArrayObject *)positions.object));
+
+  return positions.steal();
+}
+
+static PyObject *mctspool_deliver_batch(PyObject *self, PyObject *args,
+                                        PyObject *kwargs) {
+  static char avs_str[] = "avs";
+  static char priors_str[] = "priors";
+  static char *keyword_names[] = {avs_str, priors_str, NULL};
+
+  PyObject *avs_object;
+  PyObject *priors_object;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO", keyword_names,
+                                   &avs_object, &priors_object)) {
+    return NULL;
+  }
+
+  auto &pool = ((PyMCTSPool *)self)->pool;
+
+  PythonHandle avs(PyArray_FROMANY(avs_object, NPY_FLOAT32, 1, 1,
+                                   NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST));
+
+  if (avs.null()) {
+    return NULL;
+  }
+
+  PythonHandle priors(PyArray_FROMANY(priors_object, NPY_FLOAT32, 2, 2,
+                                      NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST));
+
+  if (priors.null()) {
+    return NULL;
+  }
+
+  const npy_intp *avs_dims = PyArray_DIMS((PyArrayObject *)avs.object);
+  const npy_intp *priors_dims = PyArray_DIMS((PyArrayObject *)priors.object);
+
+  if ((size_t)avs_dims[0] != pool.pending() ||
+      (size_t)priors_dims[0] != pool.pending() ||
+      (size_t)priors_dims[1] != pool.game().columns()) {
+    PyErr_Format(PyExc_ValueError,
+                 "expected %zu evaluation(s) of %u move(s)", pool.pending(),
+                 pool.game().columns());
+    return NULL;
+  }
+
+  try {
+    pool.deliver_batch((const float *)PyArray_DATA((PyArrayObject *)avs.object),
+                       (const float *)PyArray_DATA((PyArrayObject *)priors.object));
+  } catch (std::bad_alloc &) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+
+  Py_RETURN_NONE;
+}
+
+static PyObject *mctspool_collect_results(PyObject *self, PyObject *args) {
+  (void)args;
+  auto &pool = ((PyMCTSPool *)self)->pool;
+
+  std::vector<MCTSPool::Result> results;
+
+  try {
+    results = pool.collect_results();
+  } catch (std::bad_alloc &) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+
+  const ConnectK &game = pool.game();
+
+  // Each result is (score, positions, search_probabilities), where positions stacks the
+  // (2, rows, columns) position before every turn and search_probabilities holds the
+  // probability of each move at that turn (all zeros where there was no search)
+  PythonHandle results_list = iterator_to_list(
+      results.begin(), results.end(), [&game](MCTSPool::Result &result) {
+        std::vector<MCTSPool::Tree::HistoryEntry> &history = result.second;
+
+        npy_intp positions_dims[] = {(npy_intp)history.size(), 2,
+                                     (npy_intp)game.rows(),
+                                     (npy_intp)game.columns()};
+
+        PythonHandle positions(
+            PyArray_SimpleNew(4, positions_dims, NPY_FLOAT32));
+
+        if (positions.null()) {
+          return PythonHandle(NULL);
+        }
+
+        npy_intp probabilities_dims[] = {(npy_intp)history.size(),
+                                         (npy_intp)game.columns()};
+
+        PythonHandle search_probabilities(
+            PyArray_ZEROS(2, probabilities_dims, NPY_FLOAT32, 0));
+
+        if (search_probabilities.null()) {
+          return PythonHandle(NULL);
+        }
+
+        float *position =
+            (float *)PyArray_DATA((PyArrayObject *)positions.object);
+        float *probabilities =
+            (float *)PyArray_DATA((PyArrayObject *)search_probabilities.object);
+
+        for (const auto &entry : history) {
+          entry.game_state.position(position);
+          position += 2 * game.rows() * game.columns();
+
+          for (const auto &move_and_probability : entry.search_probabilities) {
+            probabilities[move_and_probability.first] =
+                (float)move_and_probability.second;
+          }
+
+          probabilities += game.columns();
+        }
+
+        return PythonHandle(Py_BuildValue("dNN", result.first,
+                                          positions.steal(),
+                                          search_probabilities.steal()));
+      });
+
+  return results_list.steal();
+}
+
+static PyObject *connectk_wrap(PyTypeObject *type, const ConnectK &state) {
+  PyObject *self = PyObject_New(PyObject, type);
+
+  if (self == NULL) {
+    return NULL;
+  }
+
+  new (&((PyConnectK *)self)->state) ConnectK(state);
+
+  return self;
+}
+
+static PyObject *connectk_create(PyTypeObject *type, PyObject *args,
+                                 PyObject *kwargs) {
+  Py_ssize_t rows;
+  Py_ssize_t columns;
+  Py_ssize_t k;
+
+  static char rows_str[] = "rows";
+  static char columns_str[] = "columns";
+  static char k_str[] = "k";
+
+  static char *keyword_names[] = {rows_str, columns_str, k_str, NULL};
+
+  // Parsed as signed integers, since "I" would silently wrap negative values around
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "nnn", keyword_names, &rows,
+                                   &columns, &k)) {
+    return NULL;
+  }
+
+  if (!ConnectK::valid_dimensions(rows, columns, k)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "rows, columns and k must be positive, k must be at most "
+                    "64, and columns * (rows + 1) must be at most 64");
+    return NULL;
+  }
+
+  return connectk_wrap(type, ConnectK((unsigned)rows, (unsigned)columns,
+                                      (unsigned)k));
+}
+
+static void connectk_destroy(PyObject *self) {
+  auto &state = ((PyConnectK *)self)->state;
+  state.~ConnectK();
+  Py_TYPE(self)->tp_free(self);
+}
+
+static PyObject *connectk_moves(PyObject *self, PyObject *args) {
+  (void)args;
+  auto &state = ((PyConnectK *)self)->state;
+
+  const uint64_t legal = state.legal_moves();
+
+  // The list is allocated at its final size rather than grown one append at a time
+  PythonHandle moves(PyList_New(std::bitset<64>(legal).count()));
+
+  if (moves.null()) {
+    return NULL;
+  }
+
+  Py_ssize_t index = 0;
+
+  for (unsigned column = 0; column < state.columns(); column++) {
+    if (!((legal >> column) & 1)) {
+      continue;
+    }
+
+    PyObject *move = PyLong_FromUnsignedLong(column);
+
+    if (move == NULL) {
+      return NULL;
+    }
+
+    PyList_SET_ITEM(moves.object, index++, move);
+  }
+
+  return moves.steal();
+}
+
+static PyObject *connectk_play(PyObject *self, PyObject *column_object) {
+  auto &state = ((PyConnectK *)self)->state;
+
+  const long column = PyLong_AsLong(column_object);
+
+  if (column == -1 && PyErr_Occurred()) {
+    return NULL;
+  }
+
+  if (column < 0 || !state.legal((unsigned)column)) {
+    PyErr_Format(PyExc_ValueError, "illegal move %ld", column);
+    return NULL;
+  }
+
+  return connectk_wrap(Py_TYPE(self), state.play((unsigned)column));
+}
+
+static PyObject *connectk_position(PyObject *self, PyObject *args,
+                                   PyObject *kwargs) {
+  static char out_str[] = "out";
+  static char *keyword_names[] = {out_str, NULL};
+
+  PyObject *out = Py_None;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", keyword_names, &out)) {
+    return NULL;
+  }
+
+  auto &state = ((PyConnectK *)self)->state;
+
+  npy_intp dims[] = {2, (npy_intp)state.rows(), (npy_intp)state.columns()};
+
+  if (out != Py_None && PyArray_Check(out)) {
+    PyArrayObject *array = (PyArrayObject *)out;
+
+    // Write straight into the caller's buffer when it's laid out exactly as expected
+    if (PyArray_TYPE(array) == NPY_FLOAT32 && PyArray_NDIM(array) == 3 &&
+        PyArray_ISCARRAY(array) && PyArray_DIMS(array)[0] == dims[0] &&
+        PyArray_DIMS(array)[1] == dims[1] && PyArray_DIMS(array)[2] == dims[2]) {
+      state.position((float *)PyArray_DATA(array));
+      return PythonHandle::copy(out).steal();
+    }
+  } else if (out != Py_None) {
+    PyErr_SetString(PyExc_TypeError, "out must be a numpy array");
+    return NULL;
+  }
+
+  PythonHandle position(PyArray_SimpleNew(3, dims, NPY_FLOAT32));
+
+  if (position.null()) {
+    return NULL;
+  }
+
+  state.position((float *)PyArray_DATA((PyArrayObject *)position.object));
+
+  if (out == Py_None) {
+    return position.steal();
+  }
+
+  if (PyArray_CopyInto((PyArrayObject *)out,
+                       (PyArrayObject *)position.object) < 0) {
+    return NULL;
+  }
+
+  return PythonHandle::copy(out).steal();
+}
+
+static PyObject *connectk_outcome(PyObject *self, PyObject *args) {
+  (void)args;
+  auto &state = ((PyConnectK *)self)->state;
+
+  if (!state.over()) {
+    Py_RETURN_NONE;
+  }
+
+  return PyLong_FromLong(state.outcome());
+}
+
+// States are unpickled through _from_state rather than __setstate__, so that a state is
+// only ever built whole and validated, and existing instances can't be overwritten
+static PyObject *connectk_reduce(PyObject *self, PyObject *args) {
+  (void)args;
+  auto &state = ((PyConnectK *)self)->state;
+
+  PyObject *from_state =
+      PyObject_GetAttrString((PyObject *)Py_TYPE(self), "_from_state");
+
+  if (from_state == NULL) {
+    return NULL;
+  }
+
+  return Py_BuildValue("N(IIIKKi)", from_state, state.rows(), state.columns(),
+                       state.k(), (unsigned long long)state.mine(),
+                       (unsigned long long)state.theirs(), state.outcome());
+}
+
+static PyObject *connectk_from_state(PyObject *type, PyObject *args) {
+  Py_ssize_t rows;
+  Py_ssize_t columns;
+  Py_ssize_t k;
+  PyObject *mine_object;
+  PyObject *theirs_object;
+  int outcome;
+
+  if (!PyArg_ParseTuple(args, "nnnO!O!i", &rows, &columns, &k, &PyLong_Type,
+                        &mine_object, &PyLong_Type, &theirs_object, &outcome)) {
+    return NULL;
+  }
+
+  if (!ConnectK::valid_dimensions(rows, columns, k)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "rows, columns and k must be positive, k must be at most "
+                    "64, and columns * (rows + 1) must be at most 64");
+    return NULL;
+  }
+
+  // Unlike "K", these raise OverflowError rather than wrapping out-of-range boards
+  const unsigned long long mine = PyLong_AsUnsignedLongLong(mine_object);
+
+  if (mine == (unsigned long long)-1 && PyErr_Occurred()) {
+    return NULL;
+  }
+
+  const unsigned long long theirs = PyLong_AsUnsignedLongLong(theirs_object);
+
+  if (theirs == (unsigned long long)-1 && PyErr_Occurred()) {
+    return NULL;
+  }
+
+  const ConnectK state((unsigned)rows, (unsigned)columns, (unsigned)k, mine,
+                       theirs, outcome);
+
+  if (!state.consistent()) {
+    PyErr_SetString(PyExc_ValueError,
+                    "boards and outcome don't describe a reachable position");
+    return NULL;
+  }
+
+  return connectk_wrap((PyTypeObject *)type, state);
+}
+
+static PyObject *connectk_str(PyObject *self) {
+  auto &state = ((PyConnectK *)self)->state;
+
+  const std::string border(state.columns() + 2, '#');
+
+  std::string string;
+
+  try {
+    string = border + "\n";
+
+    for (unsigned row = 0; row < state.rows(); row++) {
+      string += "#";
+
+      for (unsigned column = 0; column < state.columns(); column++) {
+        string += state.cell(row, column);
+      }
+
+      string += "#\n";
+    }
+
+    string += border;
+  } catch (std::bad_alloc &) {
+    PyErr_NoMemory();
+    return NULL;
+  }
+
+  return PyUnicode_FromStringAndSize(string.data(), (Py_ssize_t)string.size());
+}
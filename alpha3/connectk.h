@@ -0,0 +1,212 @@
+#pragma once
+
+#include <bitset>
+#include <cstddef>
+#include <cstdint>
+
+// Bitboard Connect-k, mirroring alpha3/connectk.py. Each player's pieces are stored in a
+// 64-bit word; column c occupies bits c * (rows + 1) through c * (rows + 1) + rows - 1,
+// bottom to top, and the extra bit on top of each column is an always-empty sentinel so
+// that runs of pieces can't wrap from one column into the next.
+class ConnectK {
+public:
+  static const int ongoing = 2;
+
+private:
+  unsigned rows_;
+  unsigned columns_;
+  unsigned k_;
+
+  uint64_t mine_;
+  uint64_t theirs_;
+
+  int outcome_;
+
+  unsigned stride() const { return rows_ + 1; }
+
+  unsigned bit(unsigned row, unsigned column) const {
+    return column * stride() + rows_ - 1 - row;
+  }
+
+  uint64_t occupied() const { return mine_ | theirs_; }
+
+  uint64_t top_row() const {
+    uint64_t mask = 0;
+
+    for (unsigned column = 0; column < columns_; column++) {
+      mask |= (uint64_t)1 << bit(0, column);
+    }
+
+    return mask;
+  }
+
+  bool k_connected(uint64_t board) const {
+    // Vertical, diagonal, horizontal and antidiagonal neighbours are 1, rows, rows + 1
+    // and rows + 2 bits apart. If the set bits of runs mark the starts of runs of n
+    // pieces, then ANDing runs with itself shifted by step <= n neighbours leaves the
+    // starts of runs of n + step pieces.
+    const unsigned shifts[] = {1, rows_, rows_ + 1, rows_ + 2};
+
+    for (unsigned shift : shifts) {
+      uint64_t runs = board;
+      unsigned length = 1;
+
+      while (length < k_) {
+        const unsigned step = (length < k_ - length) ? length : k_ - length;
+        const unsigned distance = shift * step;
+
+        runs = (distance >= 64) ? 0 : (runs & (runs >> distance));
+        length += step;
+      }
+
+      if (runs != 0) {
+        return true;
+      }
+    }
+
+    return false;
+  }
+
+public:
+  // Search trees default-construct the states in their nodes before assigning them
+  ConnectK() : ConnectK(0, 0, 0) {}
+
+  ConnectK(unsigned rows, unsigned columns, unsigned k, uint64_t mine = 0,
+           uint64_t theirs = 0, int outcome = ongoing)
+      : rows_(rows), columns_(columns), k_(k), mine_(mine), theirs_(theirs),
+        outcome_(outcome) {}
+
+  // Takes signed values so that callers can pass unvalidated input. rows is bounded
+  // before columns * (rows + 1) is formed, so the product can't overflow; no line on a
+  // board that fits in 64 bits is longer than 64 cells, so k is bounded by that.
+  static bool valid_dimensions(long long rows, long long columns, long long k) {
+    return rows > 0 && columns > 0 && k > 0 && k <= 64 && rows < 64 &&
+           columns <= 64 / (rows + 1);
+  }
+
+  // Whether the boards and outcome describe a position that can arise in play: pieces
+  // sit only in cells, each on the floor or on another piece, the players have moved
+  // alternately, and the outcome is the one the boards imply. States restored from
+  // untrusted input are checked with this before they're used.
+  bool consistent() const {
+    const uint64_t column_cells = ((uint64_t)1 << rows_) - 1;
+    uint64_t cells = 0;
+
+    for (unsigned column = 0; column < columns_; column++) {
+      const uint64_t pieces = (occupied() >> (column * stride())) & column_cells;
+
+      // The pieces in a column are a run of low bits
+      if ((pieces & (pieces + 1)) != 0) {
+        return false;
+      }
+
+      cells |= column_cells << (column * stride());
+    }
+
+    if ((mine_ & theirs_) != 0 || (occupied() & ~cells) != 0) {
+      return false;
+    }
+
+    const size_t mine_count = std::bitset<64>(mine_).count();
+    const size_t theirs_count = std::bitset<64>(theirs_).count();
+
+    // The player to move has made as many moves as the other player, or one fewer
+    if (theirs_count != mine_count && theirs_count != mine_count + 1) {
+      return false;
+    }
+
+    if (k_connected(mine_)) {
+      return false;
+    }
+
+    if (k_connected(theirs_)) {
+      return outcome_ == -1;
+    }
+
+    if ((occupied() & top_row()) == top_row()) {
+      return outcome_ == 0;
+    }
+
+    return outcome_ == ongoing;
+  }
+
+  unsigned rows() const { return rows_; }
+
+  unsigned columns() const { return columns_; }
+
+  unsigned k() const { return k_; }
+
+  uint64_t mine() const { return mine_; }
+
+  uint64_t theirs() const { return theirs_; }
+
+  bool over() const { return outcome_ != ongoing; }
+
+  int outcome() const { return outcome_; }
+
+  bool legal(unsigned column) const {
+    return !over() && column < columns_ &&
+           !((occupied() >> bit(0, column)) & 1);
+  }
+
+  // Bit c is set if column c is a legal move
+  uint64_t legal_moves() const {
+    if (over()) {
+      return 0;
+    }
+
+    const uint64_t top = occupied() >> (rows_ - 1);
+    uint64_t moves = 0;
+
+    for (unsigned column = 0; column < columns_; column++) {
+      moves |= (uint64_t)(~(top >> (column * stride())) & 1) << column;
+    }
+
+    return moves;
+  }
+
+  ConnectK play(unsigned column) const {
+    const uint64_t pieces = (occupied() >> (column * stride())) &
+                            (((uint64_t)1 << rows_) - 1);
+    const unsigned row = rows_ - 1 - (unsigned)std::bitset<64>(pieces).count();
+
+    ConnectK child(rows_, columns_, k_, theirs_,
+                   mine_ | ((uint64_t)1 << bit(row, column)));
+
+    // A win takes precedence over a full board, since the move that fills the board can
+    // also complete a line
+    if (child.k_connected(child.theirs_)) {
+      child.outcome_ = -1;
+    } else if (row == 0 && (child.occupied() & top_row()) == top_row()) {
+      child.outcome_ = 0;
+    }
+
+    return child;
+  }
+
+  // Writes the (2, rows, columns) planes for the player to move and their opponent
+  void position(float *out) const {
+    const uint64_t boards[] = {mine_, theirs_};
+
+    for (uint64_t board : boards) {
+      for (unsigned row = 0; row < rows_; row++) {
+        for (unsigned column = 0; column < columns_; column++) {
+          *(out++) = (float)((board >> bit(row, column)) & 1);
+        }
+      }
+    }
+  }
+
+  // '*' for the player to move, '+' for their opponent
+  char cell(unsigned row, unsigned column) const {
+    if ((mine_ >> bit(row, column)) & 1) {
+      return '*';
+    }
+
+    if ((theirs_ >> bit(row, column)) & 1) {
+      return '+';
+    }
+
+    return ' ';
+  }
+};
@@ -1,44 +1,127 @@
-from copy import copy
-
 import numpy as np
 
+# Winning lines for each board geometry, shared between all states with that geometry
+_lines_by_cell = {}
+
+def _winning_lines(rows, columns, k):
+    key = (rows, columns, k)
+
+    if key in _lines_by_cell:
+        return _lines_by_cell[key]
+
+    def bit(row, column):
+        return column * (rows + 1) + rows - 1 - row
+
+    # lines[bit] holds the mask of every k-in-a-row that passes through that cell
+    lines = [[] for _ in range(columns * (rows + 1))]
+
+    for row in range(rows):
+        for column in range(columns):
+            for dr, dc in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                cells = [(row + dr * i, column + dc * i) for i in range(k)]
+
+                if not all(0 <= r < rows and 0 <= c < columns for r, c in cells):
+                    continue
+
+                mask = 0
+
+                for r, c in cells:
+                    mask |= 1 << bit(r, c)
+
+                for r, c in cells:
+                    lines[bit(r, c)].append(mask)
+
+    _lines_by_cell[key] = lines
+
+    return lines
+
 class ConnectK:
+    # Pure-Python reference implementation of alpha3.a3mcts.ConnectK, which is the one
+    # exported by the alpha3 package.
+    #
+    # Each player's pieces are stored as an integer bitboard. Column c occupies bits
+    # c * (rows + 1) through c * (rows + 1) + rows - 1, bottom to top; the extra bit
+    # on top of each column is always empty, matching the layout of the C++ version.
+
+    __slots__ = ('_rows', '_columns', '_k', '_lines', '_top_row', '_mine', '_theirs', '_outcome', '_moves')
+
     def __init__(self, rows, columns, k):
         self._rows = rows
         self._columns = columns
         self._k = k
-        self._position = np.zeros((2, rows, columns), dtype=bool)
+        self._lines = _winning_lines(rows, columns, k)
+        self._top_row = sum(1 << self._bit(0, column) for column in range(columns))
+        self._mine = 0
+        self._theirs = 0
         self._outcome = None
+        self._moves = None
 
     def moves(self):
+        # States are never mutated after construction, so the moves are computed at most
+        # once. They're cached as a tuple, so that callers can't modify the cache.
+        if self._moves is not None:
+            return self._moves
+
         if self._outcome is not None:
-            return []
+            self._moves = ()
+            return self._moves
 
-        moves = []
+        # Shift the top cell of every column down to bit 0 in turn
+        occupied = (self._mine | self._theirs) >> (self._rows - 1)
+        stride = self._rows + 1
 
-        for column in range(self._columns):
-            if self._occupied(0, column):
-                continue
-            moves.append(column)
+        self._moves = tuple(column for column in range(self._columns) if not occupied >> (column * stride) & 1)
 
-        return moves
+        return self._moves
 
     def play(self, column):
-        for row in range(self._rows):
-            if row == self._rows - 1 or self._occupied(row + 1, column):
-                break
+        rows = self._rows
+        mine = self._mine
+        theirs = self._theirs
+
+        occupied = (mine | theirs) >> (column * (rows + 1))
+        height = (occupied & ((1 << rows) - 1)).bit_length()
+        row = rows - 1 - height
+        bit = column * (rows + 1) + height
+
+        # Built field by field, which is much cheaper than copy()
+        child = ConnectK.__new__(ConnectK)
+
+        child._rows = rows
+        child._columns = self._columns
+        child._k = self._k
+        child._lines = self._lines
+        child._top_row = self._top_row
+        child._mine = theirs
+        child._theirs = mine | (1 << bit)
+        child._outcome = None
+        child._moves = None
+
+        child._check_for_game_over(row, bit)
+
+        return child
 
-        child = copy(self)
+    def position(self, out=None):
+        # Both boards are packed into a single integer so that the planes are unpacked
+        # in one pass. That still allocates the packed bytes and a uint8 array of at
+        # most 128 unpacked bits, which the reshapes and slices only view; the float32
+        # array is allocated too unless out is given.
+        plane_bytes = (self._columns * (self._rows + 1) + 7) // 8
+        boards = self._mine | (self._theirs << (8 * plane_bytes))
 
-        child._position = np.copy(np.flip(self._position, 0))
-        child._position[1, row, column] = True
+        bits = np.unpackbits(np.frombuffer(boards.to_bytes(2 * plane_bytes, 'little'), dtype=np.uint8),
+                             bitorder='little')
+        bits = bits.reshape(2, 8 * plane_bytes)[:, :self._columns * (self._rows + 1)]
+        bits = bits.reshape(2, self._columns, self._rows + 1)[:, :, self._rows - 1::-1]
 
-        child._check_for_game_over(row, column)
+        bits = bits.transpose(0, 2, 1)
 
-        return child
+        if out is None:
+            return bits.astype('float32', order='C')
 
-    def position(self):
-        return self._position.astype('float32')
+        np.copyto(out, bits)
+
+        return out
 
     def outcome(self):
         return self._outcome
@@ -52,9 +135,11 @@ class ConnectK:
             string += "#"
 
             for column in range(self._columns):
-                if self._position[0, row, column]:
+                bit = self._bit(row, column)
+
+                if self._mine >> bit & 1:
                     char = '*'
-                elif self._position[1, row, column]:
+                elif self._theirs >> bit & 1:
                     char = '+'
                 else:
                     char = ' '
@@ -67,38 +152,15 @@ class ConnectK:
 
         return string
 
-    def _occupied(self, row, column):
-        return self._position[0, row, column] or self._position[1, row, column]
-
-    def _check_for_game_over(self, row, column):
-        if row == 0 and all(self._occupied(0, column) for column in range(self._columns)):
-            self._outcome = 0
-            return
+    def _bit(self, row, column):
+        return column * (self._rows + 1) + self._rows - 1 - row
 
-        for dr, dc in ((1, 0), (0, 1), (1, 1), (1, -1)):
-            vector = []
+    def _check_for_game_over(self, row, bit):
+        # Any new k-in-a-row must pass through the piece that was just played. A win is
+        # checked for first, since the move that fills the board can also complete a line.
+        theirs = self._theirs
 
-            for i in range(-(self._k - 1), self._k):
-                r = row + dr * i
-                c = column + dc * i
-
-                if 0 <= r < self._rows and 0 <= c < self._columns:
-                    vector.append(self._position[1, r, c])
-
-            if self._k_connected(vector):
-                self._outcome = -1
-                return
-
-    def _k_connected(self, vector):
-        run = 0
-
-        for bit in vector:
-            if bit:
-                run += 1
-
-                if run >= self._k:
-                    return True
-            else:
-                run = 0
-
-        return False
+        if any(theirs & line == line for line in self._lines[bit]):
+            self._outcome = -1
+        elif row == 0 and (self._mine | self._theirs) & self._top_row == self._top_row:
+            self._outcome = 0
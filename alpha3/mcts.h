@@ -1,3 +1,5 @@
+#pragma once
+
 #include <algorithm>
 #include <cassert>
 #include <cmath>
@@ -24,6 +26,9 @@ public:
     size_t n_visits;
     double total_av;
 
+    // Number of selected leaves awaiting expansion in this node's subtree
+    size_t n_in_flight;
+
     bool expanded() const { return n_visits != 0; }
 
     bool terminal() const { return expanded() && child == nullptr; }
@@ -58,6 +63,9 @@ private:
 
   size_t searches_this_turn_;
 
+  // Whether Dirichlet noise has been added to the root's priors this turn
+  bool noised_;
+
   Generator generator;
 
   Node *alloc_node() {
@@ -84,6 +92,23 @@ private:
     free_node(subtree);
   }
 
+  // Selected leaves are pending expansion until their evaluations come back. Until then,
+  // every node on the path counts an extra visit that was lost by the player choosing
+  // it (a virtual loss), which steers concurrent selections towards other parts of the
+  // tree.
+  void mark_in_flight(Node *node, bool in_flight) {
+    while (node != nullptr) {
+      if (in_flight) {
+        node->n_in_flight++;
+      } else {
+        assert(node->n_in_flight > 0);
+        node->n_in_flight--;
+      }
+
+      node = node->parent;
+    }
+  }
+
   void ascend_tree(Node *node, double av) {
     while (node != nullptr) {
       node->n_visits++;
@@ -135,6 +160,7 @@ private:
     root = new_root;
 
     searches_this_turn_ = 0;
+    noised_ = false;
 
     return move;
   }
@@ -178,6 +204,8 @@ public:
     return searches_this_turn_;
   }
 
+  bool noised() const { return noised_; }
+
   void add_dirichlet_noise(double alpha, double fraction) {
     assert(expanded() && !complete());
 
@@ -202,15 +230,19 @@ public:
       child->prior_probability = fraction * (*it) + (1 - fraction) * child->prior_probability;
       ++it;
     }
+
+    noised_ = true;
   }
 
+  // Returns nullptr if the search ended at a terminal node (which counts as a search),
+  // or if it reached a leaf that's already pending expansion (which doesn't)
   Node *select_leaf() {
     Node *node = root;
 
     while (node->expanded()) {
       if (node->terminal()) {
-        node->n_visits++;
-        ascend_tree(node->parent, -node->total_av);
+        // A terminal node's value is fixed, so each revisit backs up that same value
+        ascend_tree(node, node->total_av / node->n_visits);
         searches_this_turn_++;
         return nullptr;
       }
@@ -218,16 +250,28 @@ public:
       Node *best_child = nullptr;
       double best_score = 0.0;
 
+      const size_t node_visits = node->n_visits + node->n_in_flight;
+
+      // Everything in the exploration term but the child's prior and visit count is the
+      // same for every child, so the log and sqrt are computed once per node rather than
+      // once per child
+      const double exploration =
+          (log((1 + node_visits + c_base) / c_base) + c_init) *
+          sqrt((double)node_visits);
+
       for (Node *child = node->child; child != nullptr;
            child = child->sibling) {
+        const size_t child_visits = child->n_visits + child->n_in_flight;
+
+        // A node's total_av is from the perspective of the player to move at that node,
+        // i.e. the opponent of the player choosing it
         const double average_av =
-            (child->n_visits == 0) ? 0.0 : (child->total_av / child->n_visits);
+            (child_visits == 0)
+                ? 0.0
+                : ((-child->total_av - child->n_in_flight) / child_visits);
 
-        const double exploration =
-            log((1 + node->n_visits + c_base) / c_base) + c_init;
         const double prior = child->prior_probability;
-        const double u =
-            exploration * prior * sqrt(node->n_visits) / (1 + child->n_visits);
+        const double u = exploration * prior / (1 + child_visits);
 
         const double score = average_av + u;
 
@@ -242,12 +286,19 @@ public:
     }
 
     assert(!node->expanded());
+
+    if (node->n_in_flight > 0) {
+      return nullptr;
+    }
+
+    mark_in_flight(node, true);
+
     return node;
   }
 
   void expand_leaf(Node *leaf, double av,
                    std::vector<ExpansionEntry> &&expansion) {
-    assert(leaf != nullptr && !leaf->expanded());
+    assert(leaf != nullptr && !leaf->expanded() && leaf->n_in_flight == 1);
 
     if (expansion.empty()) {
       leaf->child = nullptr;
@@ -266,6 +317,7 @@ public:
 
         child->n_visits = 0;
         child->total_av = 0.0;
+        child->n_in_flight = 0;
 
         if (prev_child == nullptr) {
           leaf->child = child;
@@ -279,6 +331,7 @@ public:
       prev_child->sibling = nullptr;
     }
 
+    mark_in_flight(leaf, false);
     ascend_tree(leaf, av);
 
     searches_this_turn_++;
@@ -337,7 +390,7 @@ public:
   }
 
   std::pair<double, std::vector<HistoryEntry>> collect_result() {
-    double score = root->terminal() ? root->total_av : 0.0;
+    double score = root->terminal() ? (root->total_av / root->n_visits) : 0.0;
 
     play_move(nullptr);
 
@@ -367,9 +420,11 @@ public:
 
     root->n_visits = 0;
     root->total_av = 0.0;
+    root->n_in_flight = 0;
 
     history.clear();
 
     searches_this_turn_ = 0;
+    noised_ = false;
   }
 };
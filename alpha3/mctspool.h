@@ -0,0 +1,202 @@
+#pragma once
+
+#include <bitset>
+#include <cassert>
+#include <cstddef>
+#include <deque>
+#include <memory>
+#include <utility>
+#include <vector>
+
+#include "connectk.h"
+#include "mcts.h"
+
+// Self-play over a fixed number of concurrent search trees, entirely in C++. Each round
+// trip with the evaluator is a collect_batch(), which selects leaves from every tree
+// that's ready for selection, followed by a deliver_batch() with the leaves' evaluations
+// in the same order.
+class MCTSPool {
+public:
+  typedef MCTS<ConnectK, unsigned> Tree;
+  typedef std::pair<double, std::vector<Tree::HistoryEntry>> Result;
+
+  struct Config {
+    size_t trees;
+    size_t leaves_per_tree;
+    size_t evaluations;
+    size_t max_turns;
+    double c_init;
+    double c_base;
+    double noise_alpha;
+    double noise_fraction;
+  };
+
+private:
+  const Config config;
+  const ConnectK initial_state;
+
+  std::vector<std::unique_ptr<Tree>> trees;
+
+  std::deque<Tree *> pending_selection;
+  std::vector<std::pair<Tree *, Tree::Node *>> pending_evaluation;
+
+  std::vector<Result> results;
+
+  void finish_game(Tree *tree) {
+    results.emplace_back(tree->collect_result());
+    tree->reset(initial_state, 0);
+  }
+
+  void select(Tree *tree, std::vector<Tree *> &requeue) {
+    if (tree->complete()) {
+      finish_game(tree);
+      requeue.push_back(tree);
+      return;
+    }
+
+    if (tree->searches_this_turn() >= config.evaluations) {
+      tree->move_proportional();
+
+      if (tree->complete() || tree->turns() >= config.max_turns) {
+        finish_game(tree);
+        requeue.push_back(tree);
+        return;
+      }
+    }
+
+    // Noise goes on the root's priors once per turn, as soon as they exist: before any
+    // selection if the root was expanded on an earlier turn, or else right after its
+    // own expansion. Keying this on the search count would skip turns whose first
+    // selection took several leaves.
+    if (tree->expanded() && !tree->noised()) {
+      tree->add_dirichlet_noise(config.noise_alpha, config.noise_fraction);
+    }
+
+    // Pending leaves carry a virtual loss, so that repeated selections from the same
+    // tree spread out over several leaves; selection stops early if it runs into one
+    // of them again, or into a terminal node
+    const size_t remaining = config.evaluations - tree->searches_this_turn();
+    const size_t limit = (config.leaves_per_tree < remaining) ? config.leaves_per_tree : remaining;
+
+    size_t leaves = 0;
+
+    for (size_t i = 0; i < limit; i++) {
+      Tree::Node *leaf = tree->select_leaf();
+
+      if (leaf == nullptr) {
+        break;
+      }
+
+      if (leaf->state().over()) {
+        tree->expand_leaf(leaf, leaf->state().outcome(), {});
+      } else {
+        pending_evaluation.emplace_back(tree, leaf);
+        leaves++;
+      }
+    }
+
+    if (leaves == 0) {
+      requeue.push_back(tree);
+    }
+  }
+
+public:
+  MCTSPool(const Config &config_, const ConnectK &initial_state_)
+      : config(config_), initial_state(initial_state_) {
+    for (size_t i = 0; i < config.trees; i++) {
+      trees.emplace_back(new Tree(config.c_init, config.c_base, initial_state, 0));
+      pending_selection.push_back(trees.back().get());
+    }
+  }
+
+  size_t pending() const { return pending_evaluation.size(); }
+
+  // Each tree has at most leaves_per_tree leaves pending at once
+  size_t max_batch() const { return config.trees * config.leaves_per_tree; }
+
+  // Selects leaves until at least one of them needs evaluating, and returns how many do
+  size_t collect_batch() {
+    assert(pending_evaluation.empty());
+
+    std::vector<Tree *> requeue;
+
+    while (pending_evaluation.empty()) {
+      while (!pending_selection.empty()) {
+        Tree *tree = pending_selection.front();
+        pending_selection.pop_front();
+
+        select(tree, requeue);
+      }
+
+      pending_selection.insert(pending_selection.end(), requeue.begin(), requeue.end());
+      requeue.clear();
+    }
+
+    return pending_evaluation.size();
+  }
+
+  // Writes the positions of the pending leaves, in order, as consecutive
+  // (2, rows, columns) planes
+  void positions(float *out) const {
+    const size_t size = 2 * initial_state.rows() * initial_state.columns();
+
+    for (const auto &entry : pending_evaluation) {
+      entry.second->state().position(out);
+      out += size;
+    }
+  }
+
+  // Expands the pending leaves with their evaluations. priors holds a row of columns()
+  // move probabilities for each leaf.
+  void deliver_batch(const float *avs, const float *priors) {
+    const unsigned columns = initial_state.columns();
+
+    std::vector<Tree::ExpansionEntry> expansion;
+
+    for (size_t i = 0; i < pending_evaluation.size(); i++) {
+      Tree *tree = pending_evaluation[i].first;
+      Tree::Node *leaf = pending_evaluation[i].second;
+      const ConnectK &state = leaf->state();
+      const float *row = priors + i * columns;
+      const uint64_t legal = state.legal_moves();
+
+      // Priors are renormalized over the legal moves, falling back to uniform if the
+      // network put no weight on any of them
+      double denom = 0.0;
+
+      for (unsigned column = 0; column < columns; column++) {
+        denom += ((legal >> column) & 1) ? row[column] : 0.0f;
+      }
+
+      const double uniform = 1.0 / std::bitset<64>(legal).count();
+
+      expansion.clear();
+
+      for (unsigned column = 0; column < columns; column++) {
+        if ((legal >> column) & 1) {
+          const double prior = (denom > 0.0) ? (row[column] / denom) : uniform;
+          expansion.push_back({column, state.play(column), prior});
+        }
+      }
+
+      tree->expand_leaf(leaf, avs[i], std::move(expansion));
+
+      // A tree's leaves are queued consecutively; it's ready for selection again once
+      // the last of them has been expanded
+      if (i + 1 == pending_evaluation.size() || pending_evaluation[i + 1].first != tree) {
+        pending_selection.push_back(tree);
+      }
+    }
+
+    pending_evaluation.clear();
+  }
+
+  // Returns the games finished since the last call
+  std::vector<Result> collect_results() {
+    std::vector<Result> finished;
+    finished.swap(results);
+    return finished;
+  }
+
+  const ConnectK &game() const { return initial_state; }
+};
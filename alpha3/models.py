@@ -1,24 +1,67 @@
+import tensorflow as tf
 from tensorflow import keras
-from tensorflow.keras import layers
+from tensorflow.keras import layers, mixed_precision
+
+# Models follow the global Keras mixed precision policy, which is left to the caller to
+# set before constructing them; their outputs are float32 under any policy.
+
+def _default_data_format():
+    # cuDNN's fastest float32 convolutions are NCHW, whereas its reduced-precision kernels
+    # prefer NHWC and TensorFlow's CPU convolutions only support NHWC.
+    if tf.config.list_physical_devices("GPU") and mixed_precision.global_policy().compute_dtype == "float32":
+        return "channels_first"
+
+    return "channels_last"
+
 
 class ConvolutionalBlock(layers.Layer):
-    def __init__(self, filters, kernel_size):
+    def __init__(self, filters, kernel_size, data_format):
         super(ConvolutionalBlock, self).__init__()
 
-        self._convolution = layers.Conv2D(filters, kernel_size, padding="same")
-        self._batch_norm = layers.BatchNormalization()
+        self._data_format = data_format
+
+        self._convolution = layers.Conv2D(filters, kernel_size, padding="same", data_format=data_format)
+
+        # No fused= here: Keras 3 rejects it, and tf.keras already fuses by default. Batch
+        # norm is folded away at inference, and training steps are compiled with XLA, which
+        # fuses the normalization with its neighbours either way.
+        self._batch_norm = layers.BatchNormalization(axis=1 if data_format == "channels_first" else -1)
         self._activation = layers.Activation("relu")
 
-    def call(self, inputs):
-        return self._activation(self._batch_norm(self._convolution(inputs)))
+    def build(self, input_shape):
+        # The sublayers' variables are needed up front, since inference bypasses their calls
+        self._convolution.build(input_shape)
+        self._batch_norm.build(self._convolution.compute_output_shape(input_shape))
+
+        super(ConvolutionalBlock, self).build(input_shape)
+
+    def call(self, inputs, training=None):
+        if training:
+            return self._activation(self._batch_norm(self._convolution(inputs), training=training))
+
+        # Outside of training, batch normalization is a fixed per-channel affine transform,
+        # so it's folded into the convolution's kernel and bias instead of being applied
+        # as a separate pass over the activations
+        batch_norm = self._batch_norm
+
+        scale = batch_norm.gamma * tf.math.rsqrt(batch_norm.moving_variance + batch_norm.epsilon)
+        kernel = self._convolution.kernel * scale
+        bias = (self._convolution.bias - batch_norm.moving_mean) * scale + batch_norm.beta
+
+        if self._data_format == "channels_first":
+            bias = tf.reshape(bias, (-1, 1, 1))
+
+        outputs = self._convolution.convolution_op(inputs, tf.cast(kernel, inputs.dtype))
+
+        return self._activation(outputs + tf.cast(bias, inputs.dtype))
 
 
 class ResidualBlock(layers.Layer):
-    def __init__(self, filters, kernel_size):
+    def __init__(self, filters, kernel_size, data_format):
         super(ResidualBlock, self).__init__()
 
-        self._first_conv = ConvolutionalBlock(filters, kernel_size)
-        self._second_conv = ConvolutionalBlock(filters, kernel_size)
+        self._first_conv = ConvolutionalBlock(filters, kernel_size, data_format)
+        self._second_conv = ConvolutionalBlock(filters, kernel_size, data_format)
         self._add = layers.Add()
 
     def call(self, inputs):
@@ -26,44 +69,50 @@ class ResidualBlock(layers.Layer):
 
 
 class ConvNet3x3(keras.Model):
-    def __init__(self, columns):
+    # Inputs are always laid out as (batch, planes, rows, columns), as produced by
+    # ConnectK.position(); they're transposed internally when data_format is channels_last.
+
+    def __init__(self, columns, data_format=None):
         super(ConvNet3x3, self).__init__()
 
         filters = 64
         kernel_size = 3
 
-        self._tower = [ConvolutionalBlock(filters, kernel_size)]
-        self._tower.extend(ResidualBlock(filters, kernel_size) for _ in range(4))
+        if data_format is None:
+            data_format = _default_data_format()
 
-        self._outcome_head = [
-            ConvolutionalBlock(1, 1),
-            layers.Flatten(),
-            layers.Dense(64, activation="relu"),
-            layers.Dense(1, activation="tanh")
-        ]
+        self._data_format = data_format
+
+        # The tower and heads are Sequential models rather than plain lists of layers, since
+        # tf.train.Checkpoint doesn't track layers held in lists under Keras 3
+        self._tower = keras.Sequential(
+            [ConvolutionalBlock(filters, kernel_size, data_format)] +
+            [ResidualBlock(filters, kernel_size, data_format) for _ in range(4)]
+        )
 
-        self._policy_head = [
-            ConvolutionalBlock(2, 1),
-            layers.Flatten(),
-            layers.Dense(columns, activation="softmax")
-        ]
+        self._outcome_head = keras.Sequential([
+            ConvolutionalBlock(1, 1, data_format),
+            layers.Flatten(data_format=data_format),
+            layers.Dense(64, activation="relu"),
+            layers.Dense(1, activation="tanh", dtype="float32")
+        ])
 
-        self._concat = layers.Concatenate()
+        self._policy_head = keras.Sequential([
+            ConvolutionalBlock(2, 1, data_format),
+            layers.Flatten(data_format=data_format),
+            layers.Dense(columns, activation="softmax", dtype="float32")
+        ])
 
     def call(self, inputs):
         features = inputs
 
-        for layer in self._tower:
-            features = layer(features)
-
-        predicted_outcome = features
-
-        for layer in self._outcome_head:
-            predicted_outcome = layer(predicted_outcome)
+        if self._data_format == "channels_last":
+            features = tf.transpose(features, (0, 2, 3, 1))
 
-        policy = features
+        features = self._tower(features)
 
-        for layer in self._policy_head:
-            policy = layer(policy)
+        predicted_outcome = self._outcome_head(features)
+        policy = self._policy_head(features)
 
-        return self._concat([predicted_outcome, policy])
+        # Both heads end in float32 layers, so their outputs can be joined directly
+        return tf.concat([predicted_outcome, policy], axis=1)
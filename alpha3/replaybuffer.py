@@ -8,6 +8,11 @@ class ReplayBuffer:
         self._size = 0
         self._oldest_index = 0
 
+        self._random = np.random.default_rng()
+
+        self._sampled_features = self._features[:0].copy()
+        self._sampled_labels = self._labels[:0].copy()
+
     def insert(self, features, label):
         self._size = min(self._size + 1, self._max_size)
 
@@ -17,10 +22,58 @@ class ReplayBuffer:
         self._oldest_index += 1
         self._oldest_index %= self._max_size
 
-    def sample(self, size):
+    def insert_batch(self, features, labels):
+        size = len(features)
+
+        # Only the newest max_size rows of an oversized batch would survive anyway
+        if size > self._max_size:
+            skipped = size - self._max_size
+
+            features = features[skipped:]
+            labels = labels[skipped:]
+
+            self._oldest_index = (self._oldest_index + skipped) % self._max_size
+            size = self._max_size
+
+        # Rows are written with at most two slice copies: one up to the end of the
+        # buffer, and one wrapping around to its start
+        start = self._oldest_index
+        head = min(size, self._max_size - start)
+
+        np.copyto(self._features[start:start + head], features[:head])
+        np.copyto(self._labels[start:start + head], labels[:head])
+
+        np.copyto(self._features[:size - head], features[head:])
+        np.copyto(self._labels[:size - head], labels[head:])
+
+        self._size = min(self._size + size, self._max_size)
+        self._oldest_index = (start + size) % self._max_size
+
+    def sample(self, size, reuse=True):
+        # With reuse, the returned arrays are only valid until the next call to sample;
+        # otherwise they're freshly allocated, for consumers that hold on to them
         size = min(size, self._size)
-        indices = np.random.choice(self._size, size, replace=False)
-        return (self._features[indices, :], self._labels[indices, :])
+
+        # Unlike np.random.choice, which permutes the whole population, Generator.choice
+        # draws sparse samples in time proportional to the sample size
+        indices = self._random.choice(self._size, size, replace=False, shuffle=False)
+
+        if not reuse:
+            features = np.empty((size, *self._features.shape[1:]), dtype='float32')
+            labels = np.empty((size, *self._labels.shape[1:]), dtype='float32')
+        else:
+            if self._sampled_features.shape[0] < size:
+                self._sampled_features = np.empty((size, *self._features.shape[1:]), dtype='float32')
+                self._sampled_labels = np.empty((size, *self._labels.shape[1:]), dtype='float32')
+
+            features = self._sampled_features[:size]
+            labels = self._sampled_labels[:size]
+
+        # Indices are always in bounds; mode='clip' lets take write into out without buffering
+        np.take(self._features, indices, axis=0, out=features, mode='clip')
+        np.take(self._labels, indices, axis=0, out=labels, mode='clip')
+
+        return (features, labels)
 
     def __len__(self):
         return self._size
@@ -1,20 +1,34 @@
-from collections import deque
+from io import BytesIO
 from multiprocessing import Process, Pipe
 from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+from pickle import Pickler, Unpickler
+from queue import Empty, SimpleQueue
+from struct import pack_into, unpack_from
+from threading import Lock, Thread
 from time import monotonic
 
 import numpy as np
 import tensorflow as tf
 
-from alpha3.a3mcts import MCTS
+from alpha3.a3mcts import MCTSPool
 from alpha3.replaybuffer import ReplayBuffer
 
-(_TERMINATE, _EVALUATE, _EVALUATION, _RESULT) = range(4)
+# Every message is a (command, payload) pair:
+#   _TERMINATE: None
+#   _EVALUATE_BATCH: number of positions in the worker's evaluation slot
+#   _EVALUATION_BATCH: number of evaluations in the worker's evaluation slot
+#   _RESULT: (score, positions, search_probabilities)
+(_TERMINATE, _EVALUATE_BATCH, _EVALUATION_BATCH, _RESULT) = range(4)
+
+# Enables consistency checks on the examples ingested from workers
+_VALIDATE = False
 
 class Config:
     def __init__(self, workers, initial_state, model, name, **kwargs):
         self.workers = workers
         self.worker_concurrency = 32
+        self.leaves_per_tree = 1
         self.steps = 50000
 
         self.initial_state = initial_state
@@ -24,6 +38,8 @@ class Config:
         self.buffer_size = 10**5
         self.batch_size = 1024
 
+        # Decoupled (AdamW) decay: each step shrinks every weight by learning_rate *
+        # weight_decay, i.e. by 1e-7 at the initial learning rate
         self.weight_decay = 1e-3
         self.lr_schedule = ((0, 0.0001), (10000, 0.00001), (30000, 0.000001))
 
@@ -37,32 +53,84 @@ class Config:
         self.max_turns = 10**6
 
         self.checkpoint_every = 2000
+        self.checkpoints_to_keep = 5
         self.model_name = name
 
         for attr in kwargs:
             setattr(self, attr, kwargs[attr])
 
 class _BufferedPipe:
+    # Messages are pickled as they're sent, and written to the pipe together as a single
+    # frame once enough bytes have accumulated, or when the pipe is flushed. Pickles are
+    # self-delimiting, so a frame is just their concatenation, after a count of the
+    # out-of-band buffers that follow it.
+    #
+    # Large buffers (e.g. arrays of positions) are pickled out-of-band with protocol 5 and
+    # written straight from the sender's memory rather than being copied into the frame,
+    # so they mustn't be modified until the pipe is flushed.
+    _FLUSH_BYTES = 64 * 1024
+    _OUT_OF_BAND_BYTES = 16 * 1024
+
     def __init__(self, pipe):
         self.pipe = pipe
-        self._buffer = []
+        self._reset()
 
     def send(self, object):
-        self._buffer.append(object)
+        Pickler(self._frame, 5, buffer_callback=self._buffer_callback).dump(object)
 
-        if len(self._buffer) >= 96:
-            self.pipe.send(self._buffer)
-            self._buffer.clear()
+        if self._frame.tell() + self._out_of_band_size >= self._FLUSH_BYTES:
+            self.flush()
 
     def recv(self):
-        return self.pipe.recv()
+        frame = self.pipe.recv_bytes()
+
+        n_buffers, = unpack_from("!I", frame)
+
+        # Each message was pickled with a fresh memo, so each gets a fresh unpickler; they
+        # share one iterator, which hands them the out-of-band buffers in order
+        buffers = iter([self.pipe.recv_bytes() for _ in range(n_buffers)])
+
+        stream = BytesIO(frame)
+        stream.seek(4)
+
+        objects = []
+
+        while stream.tell() < len(frame):
+            objects.append(Unpickler(stream, buffers=buffers).load())
+
+        return objects
 
     def flush(self):
-        if len(self._buffer) == 0:
+        if self._frame.tell() == 4:
             return
 
-        self.pipe.send(self._buffer)
-        self._buffer.clear()
+        with self._frame.getbuffer() as frame:
+            pack_into("!I", frame, 0, len(self._out_of_band))
+            self.pipe.send_bytes(frame)
+
+        for buffer in self._out_of_band:
+            self.pipe.send_bytes(buffer)
+
+        self._reset()
+
+    def _reset(self):
+        self._frame = BytesIO()
+        self._frame.write(bytes(4))
+
+        self._out_of_band = []
+        self._out_of_band_size = 0
+
+    def _buffer_callback(self, buffer):
+        # Small buffers are cheaper to copy into the frame than to write separately
+        raw = buffer.raw()
+
+        if raw.nbytes < self._OUT_OF_BAND_BYTES:
+            return True
+
+        self._out_of_band.append(raw)
+        self._out_of_band_size += raw.nbytes
+
+        return False
 
 def train(config):
     started_at = monotonic()
@@ -79,223 +147,383 @@ def train(config):
                           features_shape=position.shape,
                           label_shape=label_shape)
 
-    optimizer = tf.keras.optimizers.Adam(learning_rate=0.0, beta_1=0.9, beta_2=0.999, amsgrad=False)
+    # The buffer is shared with the thread that samples training batches
+    buffer_lock = Lock()
 
-    log(f"spawning {config.workers} worker(s)")
+    batches = _training_batches(buffer, buffer_lock, config.batch_size, position.shape, label_shape)
 
-    pipes, process = zip(*(_spawn_worker(config) for i in range(config.workers)))
+    # Created once there's enough data to train on, since it starts sampling right away
+    batch_iterator = None
+
+    # Positions are handed to the model in its compute dtype (bfloat16 under the
+    # mixed_bfloat16 policy), which halves the bytes copied to the device for each batch;
+    # boards are all zeros and ones, so the conversion is exact
+    evaluation_dtype = tf.as_dtype(model.compute_dtype)
 
-    step = 0
-    games_played = 0
+    # XLA compiles a separate executable for every batch size it sees, so evaluation
+    # batches are padded to the next power of two to bound the number of compilations.
+    @tf.function(jit_compile=True, input_signature=[tf.TensorSpec((None, *position.shape), evaluation_dtype)])
+    def evaluate(features):
+        return model(features, training=False)
+
+    # Weight decay is applied by the optimizer, decoupled from the gradients of the loss
+    optimizer = tf.keras.optimizers.AdamW(learning_rate=0.0,
+                                          weight_decay=config.weight_decay,
+                                          beta_1=0.9,
+                                          beta_2=0.999,
+                                          amsgrad=False)
 
-    while step < config.steps:
-        log(f"waiting up to 1s for worker commands")
+    # Traced once for the fixed feature and label shapes, rather than re-running the step
+    # eagerly op by op, and compiled with XLA, which fuses the loss and optimizer updates
+    # into a handful of kernels. Batches always have the same size once training starts,
+    # so it's only compiled once.
+    @tf.function(jit_compile=True, input_signature=[
+        tf.TensorSpec((None, *position.shape), tf.float32),
+        tf.TensorSpec((None, *label_shape), tf.float32)
+    ])
+    def train_step(features, labels):
+        with tf.GradientTape() as tape:
+            predictions = model(features, training=True)
 
-        states_for_evaluation = []
+            loss = tf.reduce_sum((predictions[:, 0] - labels[:, 0])**2)
+            loss += tf.reduce_sum(tf.losses.categorical_crossentropy(labels[:, 1:], predictions[:, 1:]))
 
-        wins = 0
-        losses = 0
-        draws = 0
+            loss /= tf.cast(tf.shape(features)[0], loss.dtype)
 
-        for pipe in wait(pipes, 1):
-            buffered_pipe = _BufferedPipe(pipe)
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
 
-            for command, *args in pipe.recv():
-                if command == _EVALUATE:
-                    game_state, = args
-                    states_for_evaluation.append((game_state, buffered_pipe))
-                elif command == _RESULT:
-                    games_played += 1
+        return loss, predictions[:, 0]
 
-                    score, history = args
+    # Checkpoints are written in TensorFlow's native format, along with the optimizer's
+    # state so that training can be resumed. They're written synchronously: writes take
+    # tens of milliseconds, and async checkpointing can't copy Keras 3 variables.
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer)
+    checkpoint_manager = tf.train.CheckpointManager(checkpoint,
+                                                    directory=f"{config.model_name}_checkpoints",
+                                                    max_to_keep=config.checkpoints_to_keep)
 
-                    if abs(score) < 1e-5:
-                        score = 0
-                        draws += 1
-                    else:
-                        assert abs(score) > 0.99
-                        if score > 0:
-                            score = 1
+    # Positions for evaluation and their evaluations are exchanged through shared memory,
+    # and the pipes only carry their counts
+    max_batch = config.worker_concurrency * config.leaves_per_tree
+
+    shared_memory = SharedMemory(create=True,
+                                 size=config.workers * _evaluation_slot_bytes(max_batch, position.shape))
+
+    # Bound before anything can fail, so that the views can always be released
+    evaluation_slots = {}
+
+    try:
+        log(f"spawning {config.workers} worker(s)")
+
+        pipes, processes = zip(*(_spawn_worker(config, shared_memory, i) for i in range(config.workers)))
+
+        # Worker messages are received and unpickled on a separate thread, so that they're
+        # read off the pipes while the main thread is busy evaluating or training
+        messages = SimpleQueue()
+
+        # Each pipe keeps one _BufferedPipe for the whole run. Only the receiver thread reads
+        # from them and only the main thread writes to them, and their sending and receiving
+        # sides share no state.
+        buffered_pipes = {pipe: _BufferedPipe(pipe) for pipe in pipes}
+
+        evaluation_slots = {
+            buffered_pipes[pipe]: _evaluation_slot(shared_memory, worker, max_batch, position.shape)
+            for worker, pipe in enumerate(pipes)
+        }
+
+        def receive_messages():
+            open_pipes = set(pipes)
+
+            while len(open_pipes) > 0:
+                for pipe in wait(list(open_pipes)):
+                    buffered_pipe = buffered_pipes[pipe]
+
+                    try:
+                        messages.put((buffered_pipe, buffered_pipe.recv()))
+                    except (EOFError, OSError):
+                        open_pipes.remove(pipe)
+
+        Thread(target=receive_messages, daemon=True).start()
+
+        # Compile evaluate for every padded batch size up front, while the workers start up,
+        # rather than stalling the first few cycles on XLA compilation
+        max_evaluations = config.workers * max_batch
+
+        # Each worker has at most one batch outstanding, so every cycle's evaluations fit in
+        # a single buffer allocated up front. Rows past the end of a cycle's batch are left
+        # over from earlier cycles, which is harmless since inference treats rows independently.
+        evaluation_features = np.zeros((1 << (max_evaluations - 1).bit_length(), *position.shape),
+                                       dtype=evaluation_dtype.as_numpy_dtype)
+
+        for padded_size in (1 << i for i in range((max_evaluations - 1).bit_length() + 1)):
+            log(f"compiling evaluation for batches of {padded_size}")
+            evaluate(evaluation_features[:padded_size])
+
+        # Labels for each finished game are built in the leading rows of a scratch buffer,
+        # which insert_batch copies out of. A game has at most one turn per cell, plus the
+        # final position.
+        label_scratch = np.empty((position[0].size + 1, *label_shape), dtype='float32')
+
+        step = 0
+        games_played = 0
+
+        while step < config.steps:
+            log(f"waiting up to 1s for worker commands")
+
+            batches_for_evaluation = []
+
+            wins = 0
+            losses = 0
+            draws = 0
+
+            received = []
+
+            try:
+                received.append(messages.get(timeout=1))
+
+                while not messages.empty():
+                    received.append(messages.get())
+            except Empty:
+                pass
+
+            for buffered_pipe, objects in received:
+                for command, payload in objects:
+                    if command == _EVALUATE_BATCH:
+                        batches_for_evaluation.append((payload, buffered_pipe))
+                    elif command == _RESULT:
+                        games_played += 1
+
+                        score, positions, search_probabilities = payload
+
+                        # Terminal values are exactly -1 or 0, and a terminal node's value is
+                        # never averaged with anything else, so the score should be exact;
+                        # anything else fails here rather than being coerced into a result
+                        rounded = round(score)
+                        assert rounded == score and rounded in (-1, 0, 1), f"invalid score {score}"
+                        score = rounded
+
+                        if score == 1:
                             wins += 1
+                        elif score == 0:
+                            draws += 1
                         else:
-                            score = -1
                             losses += 1
 
-                    for i, (game_state, search_probabilities) in enumerate(history):
-                        position = game_state.position()
+                        labels = label_scratch[:len(positions)]
 
-                        label = np.zeros(label_shape)
-                        label[0] = score
+                        # The score alternates sign because players alternate turns
+                        labels[0::2, 0] = score
+                        labels[1::2, 0] = -score
 
-                        if len(search_probabilities) == 0:
-                            for i in range(1, label.shape[0]):
-                                label[i] = 1.0 / (label.shape[0] - 1)
-                        else:
-                            for move, probability in search_probabilities:
-                                label[1 + move] = probability
+                        labels[:, 1:] = search_probabilities
+
+                        # The final position wasn't searched, since the game was already over;
+                        # its policy target is uniform
+                        labels[~search_probabilities.any(axis=1), 1:] = 1.0 / search_probabilities.shape[1]
+
+                        if _VALIDATE:
+                            np.testing.assert_allclose(np.sum(labels[:, 1:], axis=1), 1.0, atol=1e-5)
 
-                        assert abs(np.sum(label[1:]) - 1) < 1e-5
+                        with buffer_lock:
+                            buffer.insert_batch(positions, labels)
+                    else:
+                        assert False, f"invalid command {command}"
 
-                        buffer.insert(position, label)
+            n_evaluations = sum(n for n, _ in batches_for_evaluation)
 
-                        score = -score
-                else:
-                    assert False, f"invalid command {command}"
+            log(f"received {n_evaluations} position(s) for evaluation in {len(batches_for_evaluation)} batch(es)")
+            log(f"ingested {wins + losses + draws} game result(s), w/l/d {wins}/{losses}/{draws}")
+            log(f"played {games_played} game(s) total thus far")
 
-        log(f"received {len(states_for_evaluation)} state(s) for evaluation")
-        log(f"ingested {wins + losses + draws} game result(s), w/l/d {wins}/{losses}/{draws}")
-        log(f"played {games_played} game(s) total thus far")
+            if n_evaluations > 0:
+                log(f"evaluating {n_evaluations} position(s)")
 
-        if len(states_for_evaluation) > 0:
-            evaluation_features = np.stack([state.position() for state, _ in states_for_evaluation])
+                # Every worker's batch is evaluated in a single call, and each worker is sent
+                # back its own slice of the results
+                padded_size = 1 << (n_evaluations - 1).bit_length()
 
-            log(f"evaluating {evaluation_features.shape[0]} position(s)")
-            evaluations = model(evaluation_features)
+                offset = 0
 
-            log(f"evaluation complete; emitting responses")
+                # Slots are indexed in place rather than unpacked, so that no views of the shared
+                # memory outlive the loop and it can be closed at the end of training
+                for n, buffered_pipe in batches_for_evaluation:
+                    evaluation_features[offset:offset + n] = evaluation_slots[buffered_pipe][0][:n]
+                    offset += n
 
-            for i, (state, pipe) in enumerate(states_for_evaluation):
-                av = float(evaluations[i, 0])
-                priors = evaluations[i, 1:]
+                evaluations = evaluate(evaluation_features[:padded_size]).numpy()
 
-                denom = sum(priors[move] for move in state.moves())
+                log(f"evaluation complete; emitting responses")
 
-                expansion = [(move, state.play(move), priors[move] / denom) for move in state.moves()]
+                offset = 0
 
-                pipe.send((_EVALUATION, av, expansion))
+                for n, buffered_pipe in batches_for_evaluation:
+                    evaluation_slots[buffered_pipe][1][:n] = evaluations[offset:offset + n, 0]
+                    evaluation_slots[buffered_pipe][2][:n] = evaluations[offset:offset + n, 1:]
+                    buffered_pipe.send((_EVALUATION_BATCH, n))
+                    offset += n
 
-            for _, pipe in states_for_evaluation:
-                pipe.flush()
+                for buffered_pipe in buffered_pipes.values():
+                    buffered_pipe.flush()
 
-            log(f"done")
+                log(f"done")
 
-        if len(buffer) >= 4 * config.batch_size:
-            step += 1
+            if len(buffer) >= 4 * config.batch_size:
+                step += 1
 
-            learning_rate = None
+                learning_rate = None
 
-            for threshold, lr in config.lr_schedule:
-                if step >= threshold:
-                    learning_rate = lr
+                for threshold, lr in config.lr_schedule:
+                    if step >= threshold:
+                        learning_rate = lr
 
-            assert learning_rate is not None
-            optimizer.learning_rate = learning_rate
+                assert learning_rate is not None
+                optimizer.learning_rate = learning_rate
 
-            features, labels = buffer.sample(config.batch_size)
+                if batch_iterator is None:
+                    batch_iterator = iter(batches)
 
-            log(f"training against {features.shape[0]} of {len(buffer)} example(s) (step {step})")
+                features, labels = next(batch_iterator)
 
-            with tf.GradientTape() as tape:
-                predictions = model(features)
+                log(f"training against {features.shape[0]} of {len(buffer)} example(s) (step {step})")
 
-                loss = tf.reduce_sum((predictions[:, 0] - labels[:, 0])**2)
-                loss += tf.reduce_sum(tf.losses.categorical_crossentropy(predictions[:, 1:], labels[:, 1:]))
+                loss, predicted_outcomes = train_step(features, labels)
 
-                loss /= features.shape[0]
+                log(f"done")
 
-                for variable in model.trainable_variables:
-                    loss = loss + config.weight_decay * tf.reduce_sum(tf.nn.l2_loss(variable))
-            
-            gradients = tape.gradient(loss, model.trainable_variables)
-            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+                predicted_outcomes = predicted_outcomes.numpy()
+                min_po = np.amin(predicted_outcomes)
+                avg_po = np.sum(predicted_outcomes) / features.shape[0]
+                max_po = np.amax(predicted_outcomes)
 
-            log(f"done")
+                log(f"min., avg., max. predicted outcome: {min_po}, {avg_po}, {max_po}")
+                log(f"loss: {float(loss)}")
 
-            predicted_outcomes = predictions[:, 0].numpy()
-            min_po = np.amin(predicted_outcomes)
-            avg_po = np.sum(predicted_outcomes) / features.shape[0]
-            max_po = np.amax(predicted_outcomes)
+                if step % config.checkpoint_every == 0:
+                    log(f"checkpointing model after {step} steps to {repr(checkpoint_manager.directory)}")
+                    checkpoint_manager.save(checkpoint_number=step)
+            else:
 
-            log(f"min., avg., max. predicted outcome: {min_po}, {avg_po}, {max_po}")
-            log(f"loss: {float(loss)}")
+                log(f"collected {len(buffer)} example(s); training starts at {4 * config.batch_size}")
 
-            if step % config.checkpoint_every == 0:
-                path = f"{config.model_name}_step{step}.h5"
-                log(f"saving model after {step} steps to {repr(path)}")
-                model.save_weights(path)
-        else:
+        log(f"trained for {config.steps} step(s)")
 
-            log(f"collected {len(buffer)} example(s); training starts at {4 * config.batch_size}")
+        for buffered_pipe in buffered_pipes.values():
+            buffered_pipe.send((_TERMINATE, None))
+            buffered_pipe.flush()
 
-    log(f"trained for {config.steps} step(s)")
+        log("waiting up to 10s for workers to exit")
 
-    for pipe in pipes:
-        pipe.send((_TERMINATE,))
-        pipe.flush()
+        # Workers are waited on together, sharing a single deadline
+        deadline = monotonic() + 10
+        running = {process.sentinel: process for process in processes}
 
-    log("waiting up to 10s for workers to exit")
+        while len(running) > 0 and monotonic() < deadline:
+            for sentinel in wait(list(running), deadline - monotonic()):
+                running.pop(sentinel).join()
 
-    waiting_at = monotonic()
+        if len(running) > 0:
+            log(f"terminating {len(running)} worker(s) that didn't exit")
 
-    for process in processes:
-        process.join(max(10 - (monotonic - waiting_at), 0.01))
+            for process in running.values():
+                process.terminate()
+                process.join()
+    finally:
+        # Runs however training ends, so that the segment is never leaked
+        evaluation_slots.clear()
 
+        shared_memory.close()
+        shared_memory.unlink()
 
-def _spawn_worker(config):
-    (pipe, worker_pipe) = Pipe(duplex=True)
-    process = Process(target=_worker, args=(worker_pipe, config), daemon=True)
-    process.start()
-    return pipe, process
 
+def _training_batches(buffer, buffer_lock, batch_size, features_shape, label_shape):
+    # Training batches are sampled by tf.data on a background thread and prefetched (onto
+    # the GPU, if there is one), so that the next batch is staged while the coordinator
+    # plays games and takes the current step. TensorFlow can wrap the sampled arrays
+    # without copying them, and a batch is still in use while the next is sampled, so
+    # each batch is sampled into fresh arrays.
+    def sample_batches():
+        while True:
+            with buffer_lock:
+                features, labels = buffer.sample(batch_size, reuse=False)
 
-def _worker(pipe, config):
-    pipe = _BufferedPipe(pipe)
+            yield features, labels
 
-    pending_selection = deque(maxlen=config.worker_concurrency)
-    pending_evaluation = deque(maxlen=config.worker_concurrency)
+    batches = tf.data.Dataset.from_generator(sample_batches, output_signature=(
+        tf.TensorSpec((None, *features_shape), tf.float32),
+        tf.TensorSpec((None, *label_shape), tf.float32)
+    )).prefetch(1)
 
-    for i in range(config.worker_concurrency):
-        pending_selection.append(MCTS(config.c_init, config.c_base, config.initial_state))
+    if tf.config.list_physical_devices("GPU"):
+        batches = batches.apply(tf.data.experimental.prefetch_to_device("/gpu:0"))
 
-    while len(pending_selection) + len(pending_evaluation) > 0:
-        requeue = []
+    return batches
 
-        while len(pending_selection) > 0:
-            mcts = pending_selection.popleft()
 
-            assert not mcts.complete()
+def _evaluation_slot_bytes(max_batch, position_shape):
+    return 4 * max_batch * (int(np.prod(position_shape)) + 1 + position_shape[-1])
 
-            if mcts.searches_this_turn() >= config.evaluations:
-                mcts.move_proportional()
 
-                if mcts.complete() or mcts.turns() >= config.max_turns:
-                    score, history = mcts.collect_result()
-                    pipe.send((_RESULT, score, history))
-                    mcts.reset(config.initial_state)
-                    requeue.append(mcts)
-                    continue
+def _evaluation_slot(shared_memory, worker, max_batch, position_shape):
+    # Each worker has its own slot in the shared memory: room for its largest possible
+    # batch of positions, followed by their avs and priors. A worker has at most one batch
+    # outstanding, and doesn't touch its slot again until that batch's evaluations arrive,
+    # so the slots need no locking.
+    position_size = int(np.prod(position_shape))
+    columns = position_shape[-1]
 
-            if mcts.searches_this_turn() == 1:
-                mcts.add_dirichlet_noise(config.noise_alpha, config.noise_fraction)
+    slot = np.ndarray((max_batch * (position_size + 1 + columns),),
+                      dtype=np.float32,
+                      buffer=shared_memory.buf,
+                      offset=worker * _evaluation_slot_bytes(max_batch, position_shape))
 
-            leaf_and_state = mcts.select_leaf()
+    positions = slot[:max_batch * position_size].reshape(max_batch, *position_shape)
+    avs = slot[max_batch * position_size:max_batch * (position_size + 1)]
+    priors = slot[max_batch * (position_size + 1):].reshape(max_batch, columns)
 
-            if leaf_and_state is None:
-                requeue.append(mcts)
-            else:
-                leaf, game_state = leaf_and_state
+    return positions, avs, priors
 
-                if game_state.outcome() is not None:
-                    mcts.expand_leaf(leaf, game_state.outcome(), [])
-                    requeue.append(mcts)
-                else:
-                    pipe.send((_EVALUATE, game_state))
-                    pending_evaluation.append((mcts, leaf))
 
-        pending_selection.extend(requeue)
+def _spawn_worker(config, shared_memory, worker):
+    (pipe, worker_pipe) = Pipe(duplex=True)
+    process = Process(target=_worker, args=(worker_pipe, config, shared_memory, worker), daemon=True)
+    process.start()
+    return pipe, process
 
-        pipe.flush()
 
-        if len(pending_evaluation) > 0:
-            for command, *args in pipe.recv():
-                if command == _TERMINATE:
-                    return
+def _worker(pipe, config, shared_memory, worker):
+    pipe = _BufferedPipe(pipe)
 
-                assert command == _EVALUATION, f"invalid command {command}"
+    # The pool runs selection, expansion and game bookkeeping for all of the worker's
+    # trees in C++; each cycle exchanges one batch of positions for their evaluations
+    pool = MCTSPool(initial_state=config.initial_state,
+                    trees=config.worker_concurrency,
+                    leaves_per_tree=config.leaves_per_tree,
+                    evaluations=config.evaluations,
+                    max_turns=config.max_turns,
+                    c_init=config.c_init,
+                    c_base=config.c_base,
+                    noise_alpha=config.noise_alpha,
+                    noise_fraction=config.noise_fraction)
+
+    slot_positions, slot_avs, slot_priors = _evaluation_slot(shared_memory,
+                                                             worker,
+                                                             config.worker_concurrency * config.leaves_per_tree,
+                                                             config.initial_state.position().shape)
+
+    while True:
+        n = len(pool.collect_batch(out=slot_positions))
+
+        for score, positions_played, search_probabilities in pool.collect_results():
+            pipe.send((_RESULT, (score, positions_played, search_probabilities)))
+
+        pipe.send((_EVALUATE_BATCH, n))
+        pipe.flush()
 
-                av, expansion = args
+        for command, payload in pipe.recv():
+            if command == _TERMINATE:
+                return
 
-                mcts, leaf = pending_evaluation.popleft()
-                mcts.expand_leaf(leaf, av, expansion)
+            assert command == _EVALUATION_BATCH, f"invalid command {command}"
 
-                pending_selection.append(mcts)
+            pool.deliver_batch(slot_avs[:payload], slot_priors[:payload])
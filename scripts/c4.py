@@ -1,29 +1,35 @@
 import numpy as np
+from tensorflow.keras import mixed_precision
 
-from alpha3 import ConnectK, train
+from alpha3 import Config, ConnectK, train
 from alpha3.models import ConvNet3x3
 
+# Compute in bfloat16 while keeping variables in float32. bfloat16 has the same exponent
+# range as float32, so unlike float16 no loss scaling is needed during training. The
+# policy has to be set before the model is constructed.
+mixed_precision.set_global_policy("mixed_bfloat16")
+
 initial_state = ConnectK(6, 7, 4)
 
 model = ConvNet3x3(7)
 model(np.zeros((1, *initial_state.position().shape)))
 
-model.load_weights('c4_c3x3_20000.h5')
-
-model = train(initial_state=initial_state,
-              model=model,
-              learning_rate=0.0001,
-              steps=100000,
-              workers=4,
-              worker_concurrency=128,
-              c_init=19652,
-              c_base=1.25,
-              alpha=0.2,
-              evaluations=100,
-              max_turns=999,
-              l2_reg=0.0005,
-              replay_buffer_size=1048576,
-              batch_size=4096,
-              checkpoint=lambda step: f"c4_c3x3_{step}.h5" if step >= 5000 and step % 1000 == 0 else None)
+# Checkpoints are written to c4_c3x3_checkpoints
+config = Config(workers=4,
+                initial_state=initial_state,
+                model=model,
+                name="c4_c3x3",
+                worker_concurrency=128,
+                steps=100000,
+                lr_schedule=((0, 0.0001),),
+                # AdamW shrinks each weight by learning_rate * weight_decay per step, which
+                # is 5e-8 of it here. That's far weaker than the old l2_reg=0.0005 loss
+                # term, so runs are much less regularized than before the switch to AdamW.
+                weight_decay=0.0005,
+                noise_alpha=0.2,
+                evaluations=100,
+                max_turns=999,
+                buffer_size=1048576,
+                batch_size=4096)
 
-model.save_weights('c4_c3x3_final.h5')
+train(config)
@@ -1,14 +1,26 @@
 import numpy as np
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
 
-from alpha3 import ConnectK, train
+from alpha3 import ConnectK
 from alpha3.models import ConvNet3x3
 
+# The same precision that scripts/c4.py trains under
+mixed_precision.set_global_policy("mixed_bfloat16")
+
 initial_state = ConnectK(6, 7, 4)
 
 model = ConvNet3x3(7)
 model(np.zeros((1, *initial_state.position().shape)))
 
-model.load_weights('c4_c3x3_20000.h5')
+# Restores the latest checkpoint written by scripts/c4.py; the optimizer's state in it
+# isn't needed here
+checkpoint_path = tf.train.latest_checkpoint('c4_c3x3_checkpoints')
+
+if checkpoint_path is None:
+       raise SystemExit("no checkpoints found in c4_c3x3_checkpoints")
+
+tf.train.Checkpoint(model=model).restore(checkpoint_path).expect_partial()
 
 game_state = initial_state
 while True:
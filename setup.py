@@ -1,6 +1,11 @@
 from distutils.core import setup, Extension
 
-a3mcts = Extension('alpha3.a3mcts', sources=['alpha3/a3mcts.cpp'])
+import numpy as np
+
+a3mcts = Extension('alpha3.a3mcts',
+                   sources=['alpha3/a3mcts.cpp'],
+                   depends=['alpha3/connectk.h', 'alpha3/mcts.h', 'alpha3/mctspool.h'],
+                   include_dirs=[np.get_include()])
 
 setup(name='alpha3',
       version='1.0.0',
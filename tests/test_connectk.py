@@ -0,0 +1,119 @@
+import pickle
+import random
+
+import numpy as np
+import pytest
+
+from alpha3.a3mcts import ConnectK
+from alpha3.connectk import ConnectK as ReferenceConnectK
+
+# Geometries with a range of aspect ratios and values of k, including boards that fill
+# all 64 bits and values of k that can't fit on the board
+_GEOMETRIES = [(6, 7, 4), (4, 5, 3), (7, 6, 5), (3, 3, 3), (6, 7, 2), (5, 9, 4), (7, 8, 4), (2, 4, 7)]
+
+
+def _k_connected(plane, k):
+    # Brute-force scan of every cell in every direction, independent of both bitboards
+    rows, columns = plane.shape
+
+    for row in range(rows):
+        for column in range(columns):
+            for dr, dc in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                cells = [(row + dr * i, column + dc * i) for i in range(k)]
+
+                if all(0 <= r < rows and 0 <= c < columns and plane[r, c] for r, c in cells):
+                    return True
+
+    return False
+
+
+@pytest.mark.parametrize("rows, columns, k", _GEOMETRIES)
+def test_matches_reference_over_random_games(rows, columns, k):
+    rng = random.Random(rows * 10000 + columns * 100 + k)
+
+    for _ in range(100):
+        state = ConnectK(rows, columns, k)
+        reference = ReferenceConnectK(rows, columns, k)
+
+        while True:
+            moves = reference.moves()
+
+            assert tuple(state.moves()) == moves
+            assert state.outcome() == reference.outcome()
+            assert str(state) == str(reference)
+
+            position = reference.position()
+
+            np.testing.assert_array_equal(state.position(), position)
+
+            out = np.full(position.shape, 7.0, dtype='float32')
+            assert state.position(out=out) is out
+            np.testing.assert_array_equal(out, position)
+
+            # The player who just moved is the only one who can have won
+            if reference.outcome() == -1:
+                assert _k_connected(position[1], k)
+            else:
+                assert not _k_connected(position[1], k)
+
+            assert not _k_connected(position[0], k)
+
+            if not moves:
+                break
+
+            move = rng.choice(moves)
+
+            state = state.play(move)
+            reference = reference.play(move)
+
+
+@pytest.mark.parametrize("rows, columns, k", [
+    (-1, 7, 4), (6, -1, 4), (6, 7, -1), (0, 7, 4), (6, 0, 4), (6, 7, 0),
+    (2**31, 2, 4), (2**32 + 6, 7, 4), (64, 1, 4), (7, 9, 4), (6, 7, 65)
+])
+def test_rejects_invalid_dimensions(rows, columns, k):
+    with pytest.raises(ValueError):
+        ConnectK(rows, columns, k)
+
+
+@pytest.mark.parametrize("rows, columns, k", _GEOMETRIES)
+def test_pickles_round_trip(rows, columns, k):
+    rng = random.Random(rows * 10000 + columns * 100 + k)
+
+    state = ConnectK(rows, columns, k)
+
+    while True:
+        restored = pickle.loads(pickle.dumps(state))
+
+        assert str(restored) == str(state)
+        assert restored.outcome() == state.outcome()
+        assert tuple(restored.moves()) == tuple(state.moves())
+
+        if not state.moves():
+            break
+
+        state = state.play(rng.choice(state.moves()))
+
+
+def test_does_not_restore_state_in_place():
+    state = ConnectK(6, 7, 4)
+
+    with pytest.raises(AttributeError):
+        state.__setstate__((1, 0, 2))
+
+
+# Boards on a 2x3 board, where column c occupies bits 3c and 3c + 1 from the bottom up
+@pytest.mark.parametrize("mine, theirs, outcome", [
+    (0b000000, 0b000001, 0),  # Wrong outcome
+    (0b000001, 0b000001, 2),  # Overlapping pieces
+    (0b000000, 0b000100, 2),  # Piece in a sentinel bit
+    (0b000000, 1 << 9, 2),  # Piece beyond the last column
+    (0b000000, 0b000010, 2),  # Floating piece
+    (0b000000, 0b001001, 2),  # Too many moves by one player
+    (0b000001, 0b000000, 2),  # Player to move has moved more often
+    (-1, 0b000001, 2),
+    (0, 1 << 64, 2),
+])
+def test_rejects_unreachable_states(mine, theirs, outcome):
+    with pytest.raises((ValueError, OverflowError)):
+        ConnectK._from_state(2, 3, 3, mine, theirs, outcome)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from alpha3.replaybuffer import ReplayBuffer
+
+
+def _contents(buffer):
+    return buffer._features, buffer._labels, len(buffer), buffer._oldest_index
+
+
+@pytest.mark.parametrize("max_size", [1, 7, 32])
+def test_insert_batch_matches_insert(max_size):
+    rng = np.random.default_rng(max_size)
+
+    batched = ReplayBuffer(max_size, (2, 3), (4,))
+    single = ReplayBuffer(max_size, (2, 3), (4,))
+
+    # Batch sizes straddle the buffer's end, and exceed its size
+    for size in [0, 1, 3, max_size - 1, max_size, max_size + 1, 2 * max_size + 3, 5]:
+        features = rng.standard_normal((size, 2, 3), dtype='float32')
+        labels = rng.standard_normal((size, 4), dtype='float32')
+
+        batched.insert_batch(features, labels)
+
+        for feature, label in zip(features, labels):
+            single.insert(feature, label)
+
+        for batched_array, single_array in zip(_contents(batched), _contents(single)):
+            np.testing.assert_array_equal(batched_array, single_array)
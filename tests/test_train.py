@@ -0,0 +1,37 @@
+from threading import Lock
+
+import numpy as np
+import pytest
+
+from alpha3.replaybuffer import ReplayBuffer
+from alpha3.train import _training_batches
+
+
+@pytest.mark.parametrize("batch_size", [32, 64, 256, 1024])
+def test_prefetching_does_not_overwrite_consumed_batches(batch_size):
+    # TensorFlow only aliases numpy arrays that happen to be suitably aligned, so several
+    # buffers are tried, each with its own sample arrays
+    for _ in range(16):
+        buffer = ReplayBuffer(4096, (2, 6, 7), (8,))
+
+        # Every row's features and label hold its index, so that features and labels from
+        # different samples can't pass for a batch
+        indices = np.arange(4096, dtype='float32')
+
+        buffer.insert_batch(np.broadcast_to(indices[:, None, None, None], (4096, 2, 6, 7)),
+                            np.broadcast_to(indices[:, None], (4096, 8)))
+
+        iterator = iter(_training_batches(buffer, Lock(), batch_size, (2, 6, 7), (8,)))
+
+        first_features, first_labels = next(iterator)
+
+        expected_features = np.array(first_features)
+        expected_labels = np.array(first_labels)
+
+        np.testing.assert_array_equal(expected_features[:, 0, 0, 0], expected_labels[:, 0])
+
+        # By the time the second batch is returned, the third has been prefetched
+        next(iterator)
+
+        np.testing.assert_array_equal(np.asarray(first_features), expected_features)
+        np.testing.assert_array_equal(np.asarray(first_labels), expected_labels)